@@ -1,29 +1,73 @@
 import os
-import json
+import re
+import gzip
+import hashlib
+import orjson
+import time
+import zipfile
+import unicodedata
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from html import escape
 from io import BytesIO
-from docx import Document
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from xml.etree.ElementTree import ParseError, iterparse
 from datetime import datetime
 
 # ============ CONFIG ===============
-GOOGLE_SERVICE_ACCOUNT = json.loads(os.environ["GOOGLE_SERVICE_ACCOUNT_JSON"])
+GOOGLE_SERVICE_ACCOUNT = orjson.loads(os.environ["GOOGLE_SERVICE_ACCOUNT_JSON"])
 DRIVE_FOLDER_ID = os.environ["GOOGLE_DRIVE_FOLDER_ID"]
 PUBLISHED_FILE_ID = os.environ["PUBLISHED_FILE_ID"]  # ID-ul fișierului published.json de pe Drive
 WP_URL = os.environ["WP_URL"]
 WP_USER = os.environ["WP_USER"]
 WP_PASS = os.environ["WP_PASS"]
 WP_CATEGORY_ID = int(os.environ["WP_CATEGORY_ID"])
+WP_GZIP = os.environ.get("WP_GZIP", "") == "1"  # doar dacă serverul decomprimă corpul cererii
+ARTICLES_PER_RUN = max(1, int(os.environ.get("ARTICLES_PER_RUN", "1")))
+MAX_WORKERS = 4  # sub limita Drive de ~10 scrieri/s per utilizator
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+DOCX_QUERY = (
+    f"'{DRIVE_FOLDER_ID}' in parents"
+    " and mimeType='application/vnd.openxmlformats-officedocument.wordprocessingml.document'"
+    " and trashed=false"
+)
+GZIP_MAGIC = b"\x1f\x8b"
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+# ============ WORDPRESS SESSION ===============
+# O singură sesiune păstrează conexiunea TLS deschisă între cereri. POST nu
+# este reîncercat automat de Retry, ca să nu se dubleze articolele.
+WP_SESSION = requests.Session()
+WP_SESSION.auth = (WP_USER, WP_PASS)
+WP_SESSION.headers["Content-Type"] = "application/json"
+WP_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=RETRY_STATUSES)
+))
 
 # ============ GOOGLE DRIVE SETUP ===============
-def get_drive_service():
-    creds = service_account.Credentials.from_service_account_info(
+@lru_cache(maxsize=1)
+def get_credentials():
+    # Importurile Google sunt amânate: sunt grele și nu toate căile din script le folosesc.
+    from google.oauth2 import service_account
+    return service_account.Credentials.from_service_account_info(
         GOOGLE_SERVICE_ACCOUNT,
         scopes=['https://www.googleapis.com/auth/drive']
     )
-    return build('drive', 'v3', credentials=creds)
+
+@lru_cache(maxsize=1)
+def get_drive_service():
+    from googleapiclient.discovery import build
+    # Documentul de discovery vine împachetat în google-api-python-client, deci nu se descarcă.
+    return build('drive', 'v3', credentials=get_credentials(),
+                 static_discovery=True, cache_discovery=False)
 
 # ============ DEBUG FUNCTION ===============
 def debug_list_files():
@@ -44,61 +88,163 @@ def debug_list_files():
         print(f"⚠️ Eroare la listarea fișierelor: {e}")
 
 # ============ PUBLISHED.JSON SYNC ===============
+def get_published_version(service):
+    return service.files().get(fileId=PUBLISHED_FILE_ID, fields="version").execute()["version"]
+
 def load_published(service):
+    from googleapiclient.http import MediaIoBaseDownload
     try:
+        # Versiunea se citește înaintea conținutului, ca o scriere concurentă să fie detectată la salvare.
+        version = get_published_version(service)
         request = service.files().get_media(fileId=PUBLISHED_FILE_ID)
         fh = BytesIO()
         downloader = MediaIoBaseDownload(fh, request)
         done = False
         while not done:
             _, done = downloader.next_chunk()
-        fh.seek(0)
-        data = json.load(fh)
+        raw = fh.getvalue()
+        # Fișierele vechi sunt JSON simplu; cele noi sunt comprimate cu gzip.
+        if raw[:2] == GZIP_MAGIC:
+            raw = gzip.decompress(raw)
+        data = orjson.loads(raw)
 
         if isinstance(data, list):
-            return {"published_ids": data, "last_published_date": ""}
-        elif isinstance(data, dict):
-            return data
-        else:
-            return {"published_ids": [], "last_published_date": ""}
+            data = {"published_ids": data, "last_published_date": ""}
+        elif not isinstance(data, dict):
+            data = {"published_ids": [], "last_published_date": ""}
     except Exception as e:
+        # Fără starea de pe Drive nu se poate ști ce s-a publicat deja, deci apelantul
+        # trebuie să se oprească, nu să continue cu o listă goală.
         print(f"⚠️ Eroare la citirea published.json: {e}")
-        return {"published_ids": [], "last_published_date": ""}
+        return None
+    # Setul ține loc listei cât rulează scriptul; se serializează înapoi la salvare.
+    data["_published_set"] = set(data.get("published_ids", []))
+    data["_version"] = version
+    data["_dirty"] = False
+    return data
 
 def save_published(service, published_data):
+    # Fișierul se rescrie integral: Drive nu permite adăugarea la final, iar lista
+    # completă de ID-uri e necesară ca să nu se republice articole vechi.
+    if not published_data["_dirty"]:
+        return
+    from googleapiclient.http import MediaIoBaseUpload
     try:
-        data = json.dumps(published_data, indent=2).encode('utf-8')
-        media_body = MediaIoBaseUpload(BytesIO(data), mimetype='application/json')
+        # Drive v3 nu acceptă If-Match la files.update, așa că versiunea se verifică
+        # explicit; dacă altă rulare a scris între timp, modificările se combină.
+        if get_published_version(service) != published_data["_version"]:
+            print("⚠️ published.json a fost modificat între timp, se combină modificările.")
+            remote = load_published(service)
+            if remote is None:
+                print("⚠️ published.json nu a fost salvat, ca să nu fie suprascris cu o stare incompletă.")
+                return
+            published_data["_published_set"] |= remote["_published_set"]
+            published_data["last_published_date"] = max(
+                published_data.get("last_published_date", ""),
+                remote.get("last_published_date", "")
+            )
+        published_data["published_ids"] = sorted(published_data["_published_set"])
+        state = {k: v for k, v in published_data.items() if not k.startswith("_")}
+        data = gzip.compress(orjson.dumps(state))
+        media_body = MediaIoBaseUpload(BytesIO(data), mimetype='application/gzip')
         service.files().update(fileId=PUBLISHED_FILE_ID, media_body=media_body).execute()
     except Exception as e:
         print(f"⚠️ Eroare la salvarea published.json: {e}")
 
 # ============ LIST FILES ===============
-def list_docx_files(service):
-    results = service.files().list(
-        q=f"'{DRIVE_FOLDER_ID}' in parents and mimeType='application/vnd.openxmlformats-officedocument.wordprocessingml.document'",
-        fields="files(id, name)"
-    ).execute()
-    return results.get('files', [])
+def list_docx_files(service, page_size=100):
+    # Generator: paginile se cer doar cât timp apelantul mai caută un fișier nepublicat.
+    page_token = None
+    while True:
+        results = service.files().list(
+            q=DOCX_QUERY,
+            fields="nextPageToken, files(id, name, md5Checksum)",
+            orderBy="createdTime",
+            pageSize=page_size,
+            pageToken=page_token
+        ).execute()
+        yield from results.get('files', [])
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
 
 # ============ DOWNLOAD FILE ===============
-def download_file(service, file_id):
-    request = service.files().get_media(fileId=file_id)
+def download_file(session, file_id, md5_checksum=None):
+    # Conținutul se scrie direct într-un singur buffer; ZIP-ul are nevoie de seek,
+    # așa că response.raw nu poate fi citit direct.
     fh = BytesIO()
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while not done:
-        _, done = downloader.next_chunk()
-    return fh.getvalue()
+    for attempt in range(DOWNLOAD_RETRIES):
+        # La reluare se cere doar restul fișierului, de la ultimul octet primit.
+        headers = {"Range": f"bytes={fh.tell()}-"} if fh.tell() else {}
+        try:
+            with session.get(f"{DRIVE_FILES_URL}/{file_id}", params={"alt": "media"},
+                             headers=headers, stream=True, timeout=60) as response:
+                if response.status_code in RETRY_STATUSES:
+                    raise ConnectionError(f"HTTP {response.status_code}")
+                response.raise_for_status()
+                if response.status_code != 206:
+                    fh.seek(0)
+                    fh.truncate()
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    fh.write(chunk)
+            # Un corp trunchiat sau corupt se descarcă din nou, nu ajunge pe WordPress.
+            if md5_checksum:
+                with fh.getbuffer() as view:
+                    digest = hashlib.md5(view).hexdigest()
+                if digest != md5_checksum:
+                    fh.seek(0)
+                    fh.truncate()
+                    raise ConnectionError("MD5 diferit de cel raportat de Drive")
+            fh.seek(0)
+            return fh
+        except (ConnectionError, requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            if attempt == DOWNLOAD_RETRIES - 1:
+                raise
+            print(f"⚠️ Descărcare întreruptă ({e}), reîncercare {attempt + 1}/{DOWNLOAD_RETRIES - 1}")
+            time.sleep(2 ** attempt)
 
 # ============ DOCX TO HTML ===============
-def docx_to_html(content_bytes):
-    doc = Document(BytesIO(content_bytes))
-    html = ""
-    for para in doc.paragraphs:
-        if para.text.strip():
-            html += f"<p>{para.text}</p>\n"
-    return html
+def paragraph_text(p):
+    # La fel ca python-docx (w:r | w:hyperlink): doar run-urile directe ale paragrafului,
+    # ca text box-urile (scrise de Word de două ori, în mc:Choice și mc:Fallback) să nu
+    # intre în textul paragrafului.
+    text = []
+    for node in p:
+        if node.tag == f"{W_NS}r":
+            runs = [node]
+        elif node.tag == f"{W_NS}hyperlink":
+            runs = node.findall(f"{W_NS}r")
+        else:
+            continue
+        for run in runs:
+            for child in run:
+                if child.tag == f"{W_NS}t":
+                    text.append(child.text or "")
+                elif child.tag == f"{W_NS}tab":
+                    text.append("\t")
+                elif child.tag in (f"{W_NS}br", f"{W_NS}cr"):
+                    text.append("\n")
+    return "".join(text)
+
+def docx_to_html(fileobj):
+    parts = []
+    depth = 0
+    with zipfile.ZipFile(fileobj) as z, z.open("word/document.xml") as f:
+        for event, el in iterparse(f, events=("start", "end")):
+            if event == "start":
+                depth += 1
+                continue
+            depth -= 1
+            # Adâncimea 2 = copiii direcți ai lui <w:body>; paragrafele din tabele
+            # sunt ignorate, ca în doc.paragraphs.
+            if depth == 2:
+                if el.tag == f"{W_NS}p":
+                    text = paragraph_text(el)
+                    if text.strip():
+                        parts.append(f"<p>{escape(text)}</p>\n")
+                el.clear()
+    return "".join(parts)
 
 # ============ PUBLISH TO WP ===============
 def publish_to_wp(title, content_html):
@@ -108,11 +254,13 @@ def publish_to_wp(title, content_html):
         "status": "publish",
         "categories": [WP_CATEGORY_ID]
     }
-    response = requests.post(
-        WP_URL,
-        auth=(WP_USER, WP_PASS),
-        json=data
-    )
+    # orjson scrie UTF-8 direct, fără escape-uri \uXXXX pentru diacritice.
+    body = orjson.dumps(data)
+    headers = {}
+    if WP_GZIP:
+        body = gzip.compress(body)
+        headers["Content-Encoding"] = "gzip"
+    response = WP_SESSION.post(WP_URL, data=body, headers=headers, timeout=30)
     if response.status_code == 201:
         print(f"✔️ Publicat: {title}")
         return True
@@ -120,11 +268,70 @@ def publish_to_wp(title, content_html):
         print(f"❌ Eroare: {response.status_code} - {response.text}")
         return False
 
+# ============ WP DUPLICATE CHECK ===============
+def slugify(title):
+    # La fel ca sanitize_title_with_dashes din WordPress: fără diacritice, punctul devine
+    # cratimă, restul semnelor se șterg, iar spațiile și cratimele consecutive devin una.
+    text = unicodedata.normalize("NFKD", title).encode("ascii", "ignore").decode("ascii")
+    text = re.sub(r"[^a-z0-9 _-]", "", text.lower().replace(".", "-"))
+    return re.sub(r"[\s-]+", "-", text).strip("-")
+
+def exists_on_wp(title):
+    slug = slugify(title)
+    # Un slug gol nu filtrează nimic: WordPress ar întoarce ultimele articole.
+    if not slug:
+        return False
+    try:
+        response = WP_SESSION.get(WP_URL, params={
+            "slug": slug,
+            "status": "publish,future,draft,pending,private",
+            "_fields": "id"
+        }, timeout=30)
+        response.raise_for_status()
+        return bool(response.json())
+    except requests.RequestException as e:
+        print(f"⚠️ Eroare la verificarea pe WordPress: {e}")
+        return False
+
+def unpublished_files(files, published_data):
+    # Articolele găsite deja pe WordPress sunt trecute în published.json fără a fi descărcate.
+    published_set = published_data["_published_set"]
+    for file in files:
+        if file['id'] in published_set:
+            continue
+        title = os.path.splitext(file['name'])[0]
+        if exists_on_wp(title):
+            print(f"↪️ Există deja pe WordPress: {title}")
+            published_set.add(file['id'])
+            published_data["_dirty"] = True
+            continue
+        yield file
+
+# ============ PUBLISH ONE FILE ===============
+def publish_file(file, download):
+    print(f"⏳ Procesare: {file['name']}")
+    try:
+        html_content = docx_to_html(download.result())
+    except (requests.RequestException, ConnectionError) as e:
+        # Include și MD5-ul care nu s-a potrivit nici după ultima reîncercare.
+        print(f"❌ Descărcare eșuată: {file['name']} - {e}")
+        return False
+    except (zipfile.BadZipFile, KeyError, ParseError) as e:
+        print(f"❌ Fișier DOCX invalid: {file['name']} - {e}")
+        return False
+    title = os.path.splitext(file['name'])[0]
+    return publish_to_wp(title, html_content)
+
 # ============ MAIN LOGIC ===============
 def main():
     service = get_drive_service()
+    # published.json nu poate intra într-un batch cu listarea: Drive nu acceptă
+    # descărcări media în cereri batch, iar listarea are loc doar după verificarea datei.
     published_data = load_published(service)
-    published_ids = published_data.get("published_ids", [])
+    if published_data is None:
+        print("🛑 Starea publicărilor nu a putut fi citită. Oprire.")
+        return
+    published_set = published_data["_published_set"]
     last_date = published_data.get("last_published_date", "")
 
     today = datetime.now().strftime("%Y-%m-%d")
@@ -132,24 +339,49 @@ def main():
         print("🛑 Astăzi deja s-a publicat un articol. Oprire.")
         return
 
-    files = list_docx_files(service)
-
-    for file in files:
-        if file['id'] in published_ids:
-            continue
-
-        print(f"⏳ Procesare: {file['name']}")
-        content_bytes = download_file(service, file['id'])
-        html_content = docx_to_html(content_bytes)
-        title = os.path.splitext(file['name'])[0]
+    from google.auth.transport.requests import AuthorizedSession
+    pending = unpublished_files(list_docx_files(service), published_data)
+    session = AuthorizedSession(get_credentials())
+    published_now = 0
 
-        if publish_to_wp(title, html_content):
-            published_ids.append(file['id'])
-            published_data["published_ids"] = published_ids
+    # Articolele eșuate sunt înlocuite cu următoarele din listă până se atinge
+    # ARTICLES_PER_RUN. Descărcările pornesc toate odată în fire separate, iar
+    # conversia și publicarea se fac în ordine, cât timp restul încă se descarcă.
+    # Starea se salvează și dacă rularea se oprește la jumătate, ca articolele deja
+    # publicate să nu fie republicate data viitoare.
+    try:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, ARTICLES_PER_RUN)) as ex:
+            while published_now < ARTICLES_PER_RUN:
+                batch = list(islice(pending, ARTICLES_PER_RUN - published_now))
+                if not batch:
+                    break
+                downloads = [
+                    (file, ex.submit(download_file, session, file['id'], file.get('md5Checksum')))
+                    for file in batch
+                ]
+                try:
+                    # Fiecare descărcare e tratată separat: una eșuată nu le anulează pe celelalte.
+                    for file, download in downloads:
+                        try:
+                            ok = publish_file(file, download)
+                        except (requests.RequestException, ConnectionError) as e:
+                            print(f"❌ Eroare la procesarea {file['name']}: {e}")
+                            continue
+                        if ok:
+                            published_set.add(file['id'])
+                            published_data["_dirty"] = True
+                            published_now += 1
+                finally:
+                    # La o eroare neprevăzută, descărcările încă nepornite nu mai sunt așteptate.
+                    for _, download in downloads:
+                        download.cancel()
+    finally:
+        if published_now:
             published_data["last_published_date"] = today
-            save_published(service, published_data)
-            break  # publică doar un articol per rulare
+        save_published(service, published_data)
 
+# Scriptul rulează o dată și iese; programarea zilnică se face din exterior, de ex.:
+#   0 9 * * * cd /cale/spre/proiect && python main.py
+# Rulările repetate în aceeași zi se opresc la verificarea last_published_date.
 if __name__ == "__main__":
     main()
-